@@ -39,10 +39,43 @@ class Renderer(App):
         self.m_view = Renderer.identity_matrix()
         m_translate(self.m_view, array('f', [0, -10, -35]))
 
+        # Fused view-projection matrix; the view and projection matrices are both fixed, so
+        # multiplying them together once here means vertices only need a single matrix multiply
+        # per frame to go from world coordinates all the way to normalised device coordinates
+        self.m_viewproj = array('f', self.m_view)
+        m_multiply(self.m_viewproj, self.m_proj)
+
         # Lighting vector
         self.v_light = array('f', [-1, -1, -2])
         v_normalise(self.v_light)
 
+        # Pre-allocated space for the model matrix and for intermediate calculations to
+        # minimise object instantiations, which really helps with performance sensitive
+        # applications like this; allocating these per frame would eventually trigger a
+        # garbage collection pause mid-animation
+        self.m_identity = Renderer.identity_matrix()
+        self.m_model = Renderer.identity_matrix()
+        self.v_camera = array('f', [0, 0, 0])
+        self.v_centre = array('f', [0, 0, 0])
+        self.face_verts = [None, None, None]
+
+        # Dirty region tracking, so that only the parts of the screen that actually changed
+        # need to be cleared and sent to the display; model_rect is the screen-space bounding
+        # box the model occupied last frame, the blit range additionally covers whatever was
+        # cleared at the start of the current frame
+        # Start with the whole screen dirty so the first frame draws everything
+        self.bounds = array('h', [0, 0, 0, 0])
+        self.model_rect = [0, 0, self.fb.width, self.fb.height]
+        self.blit_y0 = 0
+        self.blit_y1 = self.fb.height
+
+        # Overlay text redraw tracking; drawing text is a slow software pixel blit, so the
+        # static instructions are only redrawn when the model clear damages them and the FPS
+        # counter only when its value changes, drawn_fps is the value currently on screen
+        self.redraw_instructions = True
+        self.redraw_fps = True
+        self.drawn_fps = -1
+
         # Model to render
         self.mesh = Mesh(self.render_object)
 
@@ -143,7 +176,20 @@ class Renderer(App):
         self.render_background()
         self.render_scene(self.render_mode)
         self.render_foreground()
-        self.fb.blit()
+
+        # Send only the changed bands of rows to the display: any overlay text band that was
+        # redrawn plus the band the model was cleared from or drawn into, this is usually far
+        # fewer bytes over the SPI bus than pushing the full framebuffer
+        fb = self.fb
+        y0 = self.blit_y0
+        y1 = self.blit_y1
+        if self.redraw_instructions:
+            fb.blit(0, 30)
+            y0 = max(y0, 30)
+        if self.redraw_fps:
+            fb.blit(fb.height - 10, 10)
+            y1 = min(y1, fb.height - 10)
+        fb.blit(y0, y1 - y0)
 
         # Calculate frames per second
         self.frame_counter += 1
@@ -170,69 +216,92 @@ class Renderer(App):
     def render_background(self):
         fb = self.fb
 
-        # Just clear the framebuffer by filling it with a solid colour
-        fb.rect(0, 0, fb.width, fb.height, BLACK, True)
-
-        # Show some instructions on screen
-        fb.text("A = RENDER MODE", 0, 0, WHITE)
-        fb.text("B = NEXT OBJECT", 0, 10, WHITE)
-        fb.text("JOY = ROTATE", 0, 20, WHITE)
+        # Clear only the region of the framebuffer the model occupied last frame plus the
+        # overlay text bands, rather than filling the whole screen; filling fewer pixels
+        # saves a chunk of memory bandwidth every frame
+        x0, y0, x1, y1 = self.model_rect
+        damaged = x1 > x0 and y1 > y0
+        if damaged:
+            fb.rect(x0, y0, x1 - x0, y1 - y0, BLACK, True)
+
+        # The instructions never change, so only redraw them when the clear above has damaged
+        # the band of rows they sit in
+        self.redraw_instructions = damaged and y0 < 30
+        if self.redraw_instructions:
+            fb.rect(0, 0, fb.width, 30, BLACK, True)
+            fb.text("A = RENDER MODE", 0, 0, WHITE)
+            fb.text("B = NEXT OBJECT", 0, 10, WHITE)
+            fb.text("JOY = ROTATE", 0, 20, WHITE)
+
+        # Similarly the FPS counter band only needs clearing when the counter's value has
+        # changed since it was last drawn, or when the clear above has damaged it; the text
+        # itself is drawn in render_foreground so it appears on top of the model
+        self.redraw_fps = self.fps != self.drawn_fps or (damaged and y1 > fb.height - 10)
+        if self.redraw_fps:
+            fb.rect(0, fb.height - 10, fb.width, 10, BLACK, True)
 
     def render_scene(self, render_mode):
         fb = self.fb
 
-        # Cached references to frequently accessed mesh properties
+        # Cached references to frequently accessed properties; locals are indexed directly by
+        # the VM whereas every attribute access costs a dict lookup, which adds up quickly in
+        # the per-face loops below
         mesh = self.mesh
         faces = mesh.faces
-        verts = mesh.vertices_trans
-        norms = mesh.normals_trans
+        verts = mesh.vert_views
+        norms = mesh.norm_views
         depth_map = mesh.depth_map
+        campos = self.v_campos
+        m_view = self.m_view
 
         # Transform all vertices to their positions in the world by multiplying by the model
         # transformation matrix, which is specific to the mesh being rendered (create world
         # coordinates)
         # Note that translating doesn't mean anything for vectors, so normals are rotated only,
-        # and vertices are both rotated and translated
-        m_model = Renderer.identity_matrix()
+        # using just the 3x3 rotation part of the matrix, and vertices are both rotated and
+        # translated
+        m_model = self.m_model
+        m_model[:] = self.m_identity
         m_rotate(m_model, mesh.orientation)
-        v_multiply_batch(mesh.normals, m_model, norms)
+        v_rotate_batch(mesh.normals, m_model, mesh.normals_trans)
         m_translate(m_model, mesh.position)
-        v_multiply_batch(mesh.vertices, m_model, verts)
+        v_multiply_batch(mesh.vertices, m_model, mesh.vertices_trans)
 
-        # Pre-allocated space for intermediate calculations to minimise object instantiations,
-        # which really helps with performance sensitive applications like this
-        camera = array('f', [0, 0, 0])
-        centre = array('f', [0, 0, 0])
-        rgb = array('f', [0, 0, 0])
-        coords = array('h', [0] * 6)
-        face_verts = [None, None, None]
+        # Pre-allocated space for intermediate calculations, reused across frames
+        camera = self.v_camera
+        centre = self.v_centre
+        face_verts = self.face_verts
 
         # Generate a list of faces for rendering
         num_faces = 0
         for face_index in range(len(faces)):
             indices, norm_index, _ = faces[face_index]
 
-            # Calculate the point in the centre of the face
-            face_verts[0] = verts[indices[0]]
-            face_verts[1] = verts[indices[1]]
-            face_verts[2] = verts[indices[2]]
-            v_average(face_verts, centre)
-
-            # Calculate the the direction to the camera from the centre of the face
-            v_subtract(self.v_campos, centre, camera)
-            v_normalise(camera)
+            # Calculate the the direction to the camera from the face; any point on the face's
+            # plane will do for this test, so use the first vertex rather than paying to average
+            # all three for the centre
+            v_subtract(campos, verts[indices[0]], camera)
 
             # Now we use the dot product to determine if the front of the face is pointing at the
             # camera; if the angle between the normal vector and the camera vector is greater than
             # 90 degrees then we are seeing the back of the face, and if we are culling back faces
             # then we can avoid rendering it
+            # Note the camera vector is deliberately not normalised, only the sign of the dot
+            # product matters here and normalising can't change the sign, so the sqrt and the
+            # divides would be wasted work
             dot = v_dot(norms[norm_index], camera)
             if (dot < 0 and render_mode >= MODE_WIREFRAME_BACK_FACE_CULLING):
                 continue
 
             # Record the face for rendering along with its average depth from the camera, the face's
-            # depth is the z component of the centre point transformed by the camera view matrix
-            v_multiply(centre, self.m_view)
+            # depth is the z component of the centre point transformed by the camera view matrix,
+            # the centre is only needed for this depth so it is only computed for faces that
+            # survive the cull
+            face_verts[0] = verts[indices[0]]
+            face_verts[1] = verts[indices[1]]
+            face_verts[2] = verts[indices[2]]
+            v_average(face_verts, centre)
+            v_multiply(centre, m_view)
             depth_map[num_faces * 2] = face_index
             depth_map[num_faces * 2 + 1] = centre[2]
             num_faces += 1
@@ -241,84 +310,64 @@ class Renderer(App):
         # this ensures far away faces are not drawn on top of near faces
         z_sort(depth_map, num_faces)
 
-        # Since faces can share vertices, and matrix multiplication is expensive, let's not project
-        # a vertex more than once, we'll just keep a list of vertices that we've already projected
-        projected_verts = [False] * len(mesh.vertices)
-
-        # Render faces
-        m_view = self.m_view
-        m_proj = self.m_proj
-        for i in range(0, num_faces * 2, 2):
-            face_index = int(depth_map[i])
-            indices, norm_index, col_index = faces[face_index]
-
-            visible = False
-
-            # Let's go ahead and project the face's vertices
-            for j in range(3):
-                index = indices[j]
-                vertex = verts[index]
-
-                # Only project a vertex if we've not already done so
-                if not projected_verts[index]:
-                    projected_verts[index] = True
-
-                    # Transform the world coorinates into camera coordinates by multiplying by the
-                    # camera view matrix, allowing it be viewed from the camera's point of view
-                    v_multiply(vertex, m_view)
-
-                    # Project the vertex onto a 2D plane by multiplying by the projection matrix, this
-                    # yields normalised device coords where all points that lie within the viewable
-                    # space defined by the field of view are mapped to between -1.0, 1.0
-                    # The projection matrix multiplication also performs the perspective division,
-                    # which makes more distant points appear further away by making them closer together
-                    # on the x and y axes
-                    v_multiply(vertex, m_proj)
-
-                # If a face's projected vertices all lie outside the viewable space (x or y is more
-                # than 1 or less then -1) then we can cull it because it will not be seen; if at least
-                # one vertex can be seen, we'll render the partial face
-                if vertex[0] > -1 and vertex[0] < 1 and vertex[1] > -1 and vertex[1] < 1:
-                    visible = True
-
-                face_verts[j] = vertex
-
-            # If none of this face's vertices can be seen, continue to the next face
-            if not visible:
-                continue
-
-            # Convert normalised device coordinates (NDCs) to screen coordinates, if an NDC's x and y
-            # components both lie between -1 and 1, it will result in a valid on-screen pixel location
-            # This is implemented in native code for speed reasons, but it just does this:
-            #        x = (v[0] + 1) * 0.5 * width
-            #        y = (1 - (v[1] + 1) * 0.5) * height
-            # Obviously the y axis here is inverted because screens tend to have the origin 0,0 at the
-            # top left and increases towards the bottom
-            v_ndc_to_screen(face_verts, coords, fb.width, fb.height)
-
-            colour = WHITE
-            if render_mode > MODE_POINT_CLOUD and render_mode < MODE_SOLID_SHADED:
-                # Solid, unshaded colour
-                v_scale(mesh.colours[col_index], 1, rgb)
-                colour = color565(int(rgb[0]), int(rgb[1]), int(rgb[2]))
-            elif render_mode >= MODE_SOLID_SHADED:
-                # Scale the color by the angle of incidence of the light vector so a face appears
-                # more brightly lit the closer to orthogonal it is, but clamp to a minimum value
-                # so unlit faces are not totally invisible, simulating a bit of ambient light
-                dot = v_dot(norms[norm_index], self.v_light)
-                v_scale(mesh.colours[col_index], -dot, rgb)
-                colour = color565(max(int(rgb[0]), 8), max(int(rgb[1]), 8), max(int(rgb[2]), 8))
-
-            # Draw to the framebuffer using screen coordinates
-            if render_mode == MODE_POINT_CLOUD:
-                fb.points(coords, colour)
-            elif render_mode == MODE_WIREFRAME_FULL or render_mode == MODE_WIREFRAME_BACK_FACE_CULLING:
-                fb.polygon(coords, colour)
-            elif render_mode >= MODE_SOLID:
-                fb.polygon(coords, colour, True)
+        # Transform the world coordinates of every vertex into camera coordinates by multiplying
+        # by the camera view matrix, then project them onto a 2D plane by multiplying by the
+        # projection matrix, this yields normalised device coords where all points that lie within
+        # the viewable space defined by the field of view are mapped to between -1.0, 1.0
+        # The projection matrix multiplication also performs the perspective division, which makes
+        # more distant points appear further away by making them closer together on the x and y axes
+        # Both transformations are fused into a single pre-multiplied view-projection matrix, so
+        # the whole mesh is transformed with just one batched multiply per frame
+        # The model matrix is not fused in because the back-face culling above needs the vertices
+        # in world coordinates
+        v_multiply_batch(mesh.vertices_trans, self.m_viewproj, mesh.vertices_ndc)
+
+        # Process the depth-sorted faces ready for drawing in a single native call; visibility
+        # testing, conversion from normalised device coordinates to screen coordinates, lighting
+        # and colour packing all happen below the interpreter boundary, leaving only the actual
+        # framebuffer draw calls to be made from here
+        bounds = self.bounds
+        num_visible = f_process(faces, depth_map, num_faces, mesh.vertices_ndc,
+                                mesh.normals_trans, self.v_light, mesh.colours565,
+                                mesh.shade_ramps, render_mode, fb.width, fb.height,
+                                mesh.screen_coords, mesh.face_colours, bounds)
+
+        # Update the dirty region from the bounding box of the visible faces, clamped to the
+        # screen; the rows to blit have to cover both where the model is drawn now and where
+        # it was cleared from at the start of this frame
+        rect = self.model_rect
+        x0 = max(bounds[0], 0)
+        y0 = max(bounds[1], 0)
+        x1 = min(bounds[2] + 1, fb.width)
+        y1 = min(bounds[3] + 1, fb.height)
+        if x1 < x0 or y1 < y0:
+            # Nothing visible at all this frame
+            x0 = y0 = x1 = y1 = 0
+        self.blit_y0 = min(rect[1], y0)
+        self.blit_y1 = max(rect[3], y1)
+        rect[0] = x0
+        rect[1] = y0
+        rect[2] = x1
+        rect[3] = y1
+
+        # Draw the visible faces to the framebuffer using screen coordinates; the coordinates
+        # and colours are already packed into flat arrays by f_process, so solid faces are all
+        # drawn with a single native call that walks them front to back through the coverage
+        # mask, and the Python per-face loop only remains for the point and wireframe modes
+        # where the framebuffer's own draw calls are used
+        if render_mode >= MODE_SOLID:
+            fb.polygon_filled_batch(mesh.screen_coords, mesh.face_colours, num_visible)
+        else:
+            coord_views = mesh.coord_views
+            face_colours = mesh.face_colours
+            draw = fb.points if render_mode == MODE_POINT_CLOUD else fb.polygon
+            for i in range(num_visible):
+                draw(coord_views[i], face_colours[i])
 
     def render_foreground(self):
-        self.fb.text("{0:2d} fps".format(self.fps), 0, self.fb.height - 10, WHITE)
+        if self.redraw_fps:
+            self.fb.text("{0:2d} fps".format(self.fps), 0, self.fb.height - 10, WHITE)
+            self.drawn_fps = self.fps
 
 
 # Set the entrypoint for the app launcher
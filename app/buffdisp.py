@@ -1,4 +1,5 @@
 from framebuf import FrameBuffer, RGB565
+from tidal3d import f_fill_batch, f_fill_masked
 
 
 class BufferedDisplay(FrameBuffer):
@@ -21,6 +22,11 @@ class BufferedDisplay(FrameBuffer):
         self.buffer = bytearray(2 * self.width * self.height)
         super().__init__(self.buffer, self.width, self.height, RGB565)
 
+        # A 1-bit-per-pixel coverage mask for drawing faces front to back without overdraw,
+        # see polygon_filled_masked, plus a zeroed copy for resetting it quickly
+        self.cover = bytearray((self.width * self.height + 7) // 8)
+        self.cover_zero = bytes(len(self.cover))
+
     @micropython.native
     def swap_colour_bytes(self, colour):
         """
@@ -66,8 +72,46 @@ class BufferedDisplay(FrameBuffer):
         colour = self.swap_colour_bytes(colour)
         self.poly(0, 0, points, colour, fill)
 
-    def blit(self):
+    def polygon_filled(self, points, colour):
+        """
+        Draw the given list of points to the framebuffer as a closed, filled polygon
+        """
+        self.polygon(points, colour, True)
+
+    def clear_cover(self):
+        """
+        Reset the coverage mask so that no pixels are considered covered
+        """
+        self.cover[:] = self.cover_zero
+
+    def polygon_filled_masked(self, points, colour, cover):
+        """
+        Draw the given list of points to the framebuffer as a filled triangle, skipping any
+        pixels already set in the given coverage mask and marking the pixels it does draw;
+        drawing faces front to back with a shared mask means each pixel is written at most
+        once per frame
+        """
+        f_fill_masked(self.buffer, self.width, self.height, points, self.swap_colour_bytes(colour), cover)
+
+    def polygon_filled_batch(self, coords, colours, count):
+        """
+        Draw the first count triangles from the given flat coordinate and colour arrays as
+        filled triangles in a single native call, from the end of the arrays (nearest face)
+        to the start, sharing the coverage mask; one call for the whole frame avoids paying
+        the interpreter call overhead once per face
+        """
+        self.clear_cover()
+        f_fill_batch(self.buffer, self.width, self.height, coords, colours, count, self.cover)
+
+    def blit(self, y=0, height=None):
         """
-        Send the framebuffer to the display
+        Send the framebuffer to the display, optionally restricted to a horizontal band of rows
+        so that unchanged parts of the screen don't need to be re-transferred over the SPI bus
         """
-        self.display.blit_buffer(self.buffer, 0, 0, self.width, self.height)
+        if height is None:
+            height = self.height - y
+        if height <= 0:
+            return
+        start = 2 * self.width * y
+        end = start + 2 * self.width * height
+        self.display.blit_buffer(memoryview(self.buffer)[start:end], 0, y, self.width, height)
@@ -1,15 +1,134 @@
 from array import array
 from tidal3d import *
 
+# Tuning values for the vertex cache optimisation, see _forsyth_reorder; these are the numbers
+# Forsyth found to work well across a range of meshes
+_CACHE_SIZE = 32
+_CACHE_DECAY_POWER = 1.5
+_LAST_TRI_SCORE = 0.75
+_VALENCE_BOOST_SCALE = 2.0
+_VALENCE_BOOST_POWER = 0.5
+
+
+def _vertex_score(cache_pos, remaining):
+    """
+    Scores a vertex for the cache optimisation: recently used vertices score highly, tailing
+    off through the modelled cache, and vertices with only a few unemitted faces left get a
+    boost so isolated faces don't get stranded until the very end
+    """
+    if remaining <= 0:
+        return -1.0
+    score = 0.0
+    if 0 <= cache_pos < 3:
+        score = _LAST_TRI_SCORE
+    elif cache_pos >= 3:
+        score = ((_CACHE_SIZE - cache_pos) / (_CACHE_SIZE - 3)) ** _CACHE_DECAY_POWER
+    return score + _VALENCE_BOOST_SCALE * remaining ** -_VALENCE_BOOST_POWER
+
+
+def _forsyth_reorder(tris, num_verts):
+    """
+    Returns a face ordering computed with Tom Forsyth's linear-speed vertex cache optimisation
+    so that consecutive faces share vertices wherever possible; the per-frame walks over the
+    face list then tend to touch vertex data that is already hot in the CPU's data cache
+
+    tris: A list of per-face vertex index triples
+    num_verts: Total number of vertices indexed by the faces
+    """
+    num_faces = len(tris)
+
+    # Which faces use each vertex, and how many of them are still to be emitted
+    uses = [[] for _ in range(num_verts)]
+    for i in range(num_faces):
+        for v in tris[i]:
+            uses[v].append(i)
+    remaining = [len(u) for u in uses]
+
+    # Initial scores with nothing yet in the modelled post-transform cache
+    v_scores = [_vertex_score(-1, remaining[v]) for v in range(num_verts)]
+    f_scores = [v_scores[t[0]] + v_scores[t[1]] + v_scores[t[2]] for t in tris]
+    emitted = [False] * num_faces
+
+    order = []
+    cache = []
+    best_face = -1
+    while len(order) < num_faces:
+        # When the cache yields no candidate faces, fall back to scanning for the best
+        # remaining face; this mostly only happens at the start and between mesh islands
+        if best_face < 0:
+            best_score = -1.0
+            for i in range(num_faces):
+                if not emitted[i] and f_scores[i] > best_score:
+                    best_score = f_scores[i]
+                    best_face = i
+
+        emitted[best_face] = True
+        order.append(best_face)
+
+        # The emitted face's vertices move to the front of the modelled cache
+        for v in tris[best_face]:
+            remaining[v] -= 1
+            if v in cache:
+                cache.remove(v)
+            cache.insert(0, v)
+        overflow = cache[_CACHE_SIZE:]
+        del cache[_CACHE_SIZE:]
+
+        # Re-score every vertex whose cache position changed, then choose the next face from
+        # among the unemitted faces that use a cached vertex
+        for i in range(len(cache)):
+            v_scores[cache[i]] = _vertex_score(i, remaining[cache[i]])
+        for v in overflow:
+            v_scores[v] = _vertex_score(-1, remaining[v])
+        best_face = -1
+        best_score = -1.0
+        for v in cache:
+            for i in uses[v]:
+                if not emitted[i]:
+                    tri = tris[i]
+                    score = v_scores[tri[0]] + v_scores[tri[1]] + v_scores[tri[2]]
+                    f_scores[i] = score
+                    if score > best_score:
+                        best_score = score
+                        best_face = i
+
+    return order
+
+
+def _remap_vertices(tris, vertices):
+    """
+    Renumbers vertices in the order the given faces first use them, rewriting the face indices
+    in place, and returns the reordered vertex list; after the cache-optimised face reordering
+    this makes reads of the flat vertex buffer near-sequential
+    """
+    remap = [-1] * len(vertices)
+    new_verts = []
+    for tri in tris:
+        for j in range(3):
+            v = tri[j]
+            if remap[v] < 0:
+                remap[v] = len(new_verts)
+                new_verts.append(vertices[v])
+            tri[j] = remap[v]
+    return new_verts
+
 
 class Mesh:
 
     def __init__(self, filename):
         # A face is made of 3 vertices, a normal vector, and a material
-        self.vertices = []
-        self.normals = []
+        # Vertices and normals are stored flat in structure-of-arrays style, three floats per
+        # entry, so the native batch operations can walk one contiguous buffer instead of
+        # chasing a list of individually boxed arrays
+        self.vertices = None
+        self.normals = None
         self.colours = []
 
+        # Per-material ramps of pre-shaded, pre-packed RGB565 colours, and the materials'
+        # unshaded colours pre-packed the same way
+        self.shade_ramps = []
+        self.colours565 = None
+
         # To prevent duplication of data (and therefore saving on expensive memory and calculation
         # time) we store each unique vertex, normal and material once and instead keep per-face
         # indices into the above lists
@@ -28,6 +147,20 @@ class Mesh:
         self.vertices_trans = None
         self.normals_trans = None
 
+        # Pre-allocated per-entry memoryviews into the transformed buffers, for passing single
+        # vertices and normals to the non-batched vector functions without allocating
+        self.vert_views = None
+        self.norm_views = None
+
+        # Pre-allocated space for projected vertices in normalised device coordinates
+        self.vertices_ndc = None
+
+        # Pre-allocated space for visible faces' screen coordinates and packed colours, along
+        # with per-face memoryviews into the coordinate buffer for making draw calls
+        self.screen_coords = None
+        self.face_colours = None
+        self.coord_views = None
+
         # Load mesh and material data
         self._load(filename)
 
@@ -39,7 +172,6 @@ class Mesh:
         # Orientation and angular velocity
         self.orientation = array('f', [1, 0, 0, 0])
         self.angular = array('f', [0, 0, 0])
-        self.axis = array('f', [0, 0, 0])
 
     def rotate_y(self, val):
         self.angular[1] = val
@@ -52,22 +184,33 @@ class Mesh:
         op = ObjectParser()
         op.parse("apps/tidal_3d/" + filename)
 
-        self.vertices = op.vertices
+        # Reorder the faces for vertex cache locality and renumber the vertices in first-use
+        # order; .obj exporters make no promises about either, and these one-off load-time
+        # passes make the per-frame walks over the vertex data far more sequential
+        order = _forsyth_reorder([f['indices'] for f in op.faces], len(op.vertices))
+        op.faces = [op.faces[i] for i in order]
+        op.vertices = _remap_vertices([f['indices'] for f in op.faces], op.vertices)
+
         self.vert_indices = [f['indices'] for f in op.faces]
 
         # Pre-calculate face normal vectors, a normal is the direction exactly perpendicular to
         # the plane of the face, the direction the front of the face is pointing
         a = array('f', [0, 0, 0])
         b = array('f', [0, 0, 0])
+        normals = []
         for face in self.vert_indices:
-            v_subtract(self.vertices[face[0]], self.vertices[face[1]], a)
-            v_subtract(self.vertices[face[1]], self.vertices[face[2]], b)
+            v_subtract(op.vertices[face[0]], op.vertices[face[1]], a)
+            v_subtract(op.vertices[face[1]], op.vertices[face[2]], b)
             normal = array('f', [0, 0, 0])
             v_cross(a, b, normal)
             v_normalise(normal)
             # TODO normal deduplication -- "item in list" is not implemented in micropython for lists of arrays
-            self.normals.append(normal)
-            self.norm_indices.append(len(self.normals) - 1)
+            normals.append(normal)
+            self.norm_indices.append(len(normals) - 1)
+
+        # Flatten the parsed vertices and calculated normals into contiguous buffers
+        self.vertices = array('f', [f for v in op.vertices for f in v])
+        self.normals = array('f', [f for n in normals for f in n])
 
         # If the geometry has materials, let's also parse the accompanying material library file
         mp = MaterialParser()
@@ -86,6 +229,31 @@ class Mesh:
             self.colours.append(array('f', [255, 255, 255]))
             self.col_indices = [0] * len(self.vert_indices)
 
+        # Pre-compute a ramp of shaded colours for each material, 32 brightness levels from
+        # unlit to fully lit, packed ready for the framebuffer; shading a face then only needs
+        # its lighting dot product quantising to a level index rather than scaling, clamping
+        # and packing its colour from scratch every frame
+        self.shade_ramps = []
+        for colour in self.colours:
+            ramp = array('H', [0] * 32)
+            for level in range(32):
+                # Clamp to a minimum value so unlit faces are not totally invisible,
+                # simulating a bit of ambient light, and pack to RGB565 with the same
+                # layout as tidal's color565
+                r = max(int(colour[0] * level / 31), 8)
+                g = max(int(colour[1] * level / 31), 8)
+                b = max(int(colour[2] * level / 31), 8)
+                ramp[level] = (r & 0xf8) << 8 | (g & 0xfc) << 3 | b >> 3
+            self.shade_ramps.append(ramp)
+
+        # Also pre-pack each material's full-brightness colour for the unshaded modes; colours
+        # are per material not per face, so packing the same RGB bytes again for every face
+        # every frame would be pure waste
+        self.colours565 = array('H', [0] * len(self.colours))
+        for i in range(len(self.colours)):
+            colour = self.colours[i]
+            self.colours565[i] = (int(colour[0]) & 0xf8) << 8 | (int(colour[1]) & 0xfc) << 3 | int(colour[2]) >> 3
+
         # Create a face-oriented view of index data
         for i in range(len(self.vert_indices)):
             self.faces.append([self.vert_indices[i], self.norm_indices[i], self.col_indices[i]])
@@ -93,22 +261,34 @@ class Mesh:
         # Pre-allocate some working space for face index/depth pairs for depth-sorting faces
         self.depth_map = array('f', [0] * (len(self.faces) * 2))
 
-        # Pre-allocate some working space for transforming vertices and normals
-        self.vertices_trans = [None] * len(self.vertices)
-        for i in range(len(self.vertices)):
-            self.vertices_trans[i] = array('f', [0, 0, 0])
-        self.normals_trans = [None] * len(self.normals)
-        for i in range(len(self.normals)):
-            self.normals_trans[i] = array('f', [0, 0, 0])
+        # Pre-allocate some working space for visible faces' screen coordinates and colours,
+        # and the per-face views used to draw them, slicing a memoryview allocates so it is
+        # done once here rather than per face per frame
+        self.screen_coords = array('h', [0] * (len(self.faces) * 6))
+        self.face_colours = array('H', [0] * len(self.faces))
+        coords_mv = memoryview(self.screen_coords)
+        self.coord_views = [coords_mv[i:i + 6] for i in range(0, len(self.screen_coords), 6)]
+
+        # Pre-allocate some working space for transforming vertices and normals, flat buffers
+        # the same shape as the rest-pose data they are transformed from
+        self.vertices_trans = array('f', [0] * len(self.vertices))
+        self.normals_trans = array('f', [0] * len(self.normals))
+        self.vertices_ndc = array('f', [0] * len(self.vertices))
+
+        # Pre-allocate per-entry views into the transformed buffers, these are created once
+        # here because taking a memoryview slice allocates
+        trans_mv = memoryview(self.vertices_trans)
+        self.vert_views = [trans_mv[i:i + 3] for i in range(0, len(self.vertices), 3)]
+        norms_mv = memoryview(self.normals_trans)
+        self.norm_views = [norms_mv[i:i + 3] for i in range(0, len(self.normals), 3)]
 
     def update(self, delta_t):
         # Move our position by our velocity
         v_scale(self.velocity, delta_t, self.delta_v)
         v_add(self.position, self.delta_v)
-        # Rotate ourselves around the axis
-        degrees = v_magnitude(self.angular)
-        v_normalise(self.angular, self.axis)
-        q_rotate(self.orientation, degrees * delta_t, self.axis)
+        # Rotate ourselves around the angular velocity axis, integrating the orientation
+        # quaternion is a single native call rather than a magnitude/normalise/rotate sequence
+        q_integrate(self.orientation, self.angular, delta_t)
 
 
 class ParserInterface:
@@ -11,5 +11,13 @@ target_include_directories(usermod_tidal3d INTERFACE
     ${CMAKE_CURRENT_LIST_DIR}
 )
 
+# Optionally use the optimised SIMD maths routines from esp-dsp, on the ESP32-S3 the
+# processor instruction extensions can do four float multiply-adds per instruction; enable
+# by exporting TIDAL3D_USE_ESP_DSP in the firmware build environment.
+if(DEFINED ENV{TIDAL3D_USE_ESP_DSP})
+    target_compile_definitions(usermod_tidal3d INTERFACE TIDAL3D_USE_ESP_DSP=1)
+    target_link_libraries(usermod_tidal3d INTERFACE idf::esp-dsp)
+endif()
+
 # Link our INTERFACE library to the usermod target.
 target_link_libraries(usermod INTERFACE usermod_tidal3d)
@@ -1,11 +1,26 @@
 #include <math.h>
+#include <string.h>
 
 #include "py/runtime.h"
 #include "py/binary.h"
 
+// Use the optimised dot product routines from esp-dsp when enabled in the firmware build, on
+// the ESP32-S3 these are implemented with the processor instruction extensions (PIE), whose
+// 128-bit SIMD does four float multiply-adds per instruction instead of one
+#ifdef TIDAL3D_USE_ESP_DSP
+#include "dsps_dotprod.h"
+#endif
+
 // Pre-computed PI over 180
 #define DEGS_TO_RADS (0.017453)
 
+// Render modes, these must be kept in sync with the MODE_* constants in the app
+#define RENDER_MODE_POINT_CLOUD (0)
+#define RENDER_MODE_WIREFRAME_FULL (1)
+#define RENDER_MODE_WIREFRAME_BACK_FACE_CULLING (2)
+#define RENDER_MODE_SOLID (3)
+#define RENDER_MODE_SOLID_SHADED (4)
+
 // Internal helper to calculate vector magnitude used by v_magnitude and v_normalise
 STATIC mp_float_t v_magnitude_internal(float *vec, size_t len) {
 	mp_float_t sum = 0;
@@ -140,6 +155,21 @@ STATIC mp_obj_t v_average(size_t n_args, const mp_obj_t *args) {
 }
 STATIC MP_DEFINE_CONST_FUN_OBJ_VAR_BETWEEN(v_average_obj, 2, 2, v_average);
 
+// Internal helper to multiply a single homogeneous (x, y, z, 1) vector by a 4x4 matrix,
+// used by v_multiply and v_multiply_batch
+STATIC void v_multiply_internal(float *xyzw, float *vec, float *mat) {
+#ifdef TIDAL3D_USE_ESP_DSP
+	// One strided SIMD dot product per matrix column
+	for (size_t i = 0; i < 4; i++) {
+		dsps_dotprode_f32(vec, &mat[i], &xyzw[i], 4, 1, 4);
+	}
+#else
+	for (size_t i = 0; i < 4; i++) {
+		xyzw[i] = vec[0] * mat[i] + vec[1] * mat[4 + i] + vec[2] * mat[8 + i] + vec[3] * mat[12 + i];
+	}
+#endif
+}
+
 /**
  * Multiplies the given 3D vector by the given 4x4 matrix
  */
@@ -154,19 +184,16 @@ STATIC mp_obj_t v_multiply(size_t n_args, const mp_obj_t *args) {
 		dest_buffer = vec_buffer;
 	}
 
-	mp_float_t x, y, z;
-	mp_float_t xyzw[4];
+	float vec[4] = {
+		((float *)vec_buffer.buf)[0],
+		((float *)vec_buffer.buf)[1],
+		((float *)vec_buffer.buf)[2],
+		1
+	};
+	float xyzw[4];
 
 	// Do the multiplication
-	x = ((float *)vec_buffer.buf)[0];
-	y = ((float *)vec_buffer.buf)[1];
-	z = ((float *)vec_buffer.buf)[2];
-	for (size_t i = 0; i < 4; i++) {
-		xyzw[i] = x * ((float *)mat_buffer.buf)[i]
-			+ y * ((float *)mat_buffer.buf)[4 + i]
-			+ z * ((float *)mat_buffer.buf)[8 + i]
-			+ ((float *)mat_buffer.buf)[12 + i];
-	}
+	v_multiply_internal(xyzw, vec, ((float *)mat_buffer.buf));
 	if (xyzw[3] != 1) {
 		((float *)dest_buffer.buf)[0] = xyzw[0] / xyzw[3];
 		((float *)dest_buffer.buf)[1] = xyzw[1] / xyzw[3];
@@ -182,46 +209,43 @@ STATIC mp_obj_t v_multiply(size_t n_args, const mp_obj_t *args) {
 STATIC MP_DEFINE_CONST_FUN_OBJ_VAR_BETWEEN(v_multiply_obj, 2, 3, v_multiply);
 
 /**
- * Multiplies each of the 3D vectors in the given list by the given 4x4 matrix
+ * Multiplies each of the 3D vectors in the given flat buffer by the given 4x4 matrix, vectors
+ * are packed contiguously as three floats per entry so that the whole batch is one pass over
+ * a single buffer with no per-element unboxing
  */
 STATIC mp_obj_t v_multiply_batch(size_t n_args, const mp_obj_t *args) {
-	size_t list_len;
-	mp_obj_t *vec_list, *dest_list;
 	mp_buffer_info_t vec_buffer, mat_buffer, dest_buffer;
 
-	mp_obj_get_array(args[0], &list_len, &vec_list);
+	mp_get_buffer_raise(args[0], &vec_buffer, MP_BUFFER_READ);
 	mp_get_buffer_raise(args[1], &mat_buffer, MP_BUFFER_READ);
 	if (n_args > 2) {
-		mp_obj_get_array_fixed_n(args[2], list_len, &dest_list);
+		mp_get_buffer_raise(args[2], &dest_buffer, MP_BUFFER_RW);
 	} else {
-		dest_list = vec_list;
+		dest_buffer = vec_buffer;
 	}
 
-	mp_float_t x, y, z;
-	mp_float_t xyzw[4];
+	float *src = (float *)vec_buffer.buf;
+	float *mat = (float *)mat_buffer.buf;
+	float *dest = (float *)dest_buffer.buf;
+	size_t num_vecs = vec_buffer.len / (sizeof(float) * 3);
 
-	for (size_t j = 0; j < list_len; j++) {
-		mp_get_buffer_raise(vec_list[j], &vec_buffer, MP_BUFFER_READ);
-		mp_get_buffer_raise(dest_list[j], &dest_buffer, MP_BUFFER_RW);
+	float vec[4] = {0, 0, 0, 1};
+	float xyzw[4];
 
+	for (size_t j = 0; j < num_vecs; j++) {
 		// Do the multiplication
-		x = ((float *)vec_buffer.buf)[0];
-		y = ((float *)vec_buffer.buf)[1];
-		z = ((float *)vec_buffer.buf)[2];
-		for (size_t i = 0; i < 4; i++) {
-			xyzw[i] = x * ((float *)mat_buffer.buf)[i]
-				+ y * ((float *)mat_buffer.buf)[4 + i]
-				+ z * ((float *)mat_buffer.buf)[8 + i]
-				+ ((float *)mat_buffer.buf)[12 + i];
-		}
+		vec[0] = src[j * 3];
+		vec[1] = src[j * 3 + 1];
+		vec[2] = src[j * 3 + 2];
+		v_multiply_internal(xyzw, vec, mat);
 		if (xyzw[3] != 1) {
-			((float *)dest_buffer.buf)[0] = xyzw[0] / xyzw[3];
-			((float *)dest_buffer.buf)[1] = xyzw[1] / xyzw[3];
-			((float *)dest_buffer.buf)[2] = xyzw[2] / xyzw[3];
+			dest[j * 3] = xyzw[0] / xyzw[3];
+			dest[j * 3 + 1] = xyzw[1] / xyzw[3];
+			dest[j * 3 + 2] = xyzw[2] / xyzw[3];
 		} else {
-			((float *)dest_buffer.buf)[0] = xyzw[0];
-			((float *)dest_buffer.buf)[1] = xyzw[1];
-			((float *)dest_buffer.buf)[2] = xyzw[2];
+			dest[j * 3] = xyzw[0];
+			dest[j * 3 + 1] = xyzw[1];
+			dest[j * 3 + 2] = xyzw[2];
 		}
 	}
 
@@ -229,6 +253,48 @@ STATIC mp_obj_t v_multiply_batch(size_t n_args, const mp_obj_t *args) {
 }
 STATIC MP_DEFINE_CONST_FUN_OBJ_VAR_BETWEEN(v_multiply_batch_obj, 2, 3, v_multiply_batch);
 
+/**
+ * Rotates each of the 3D vectors in the given flat buffer by the rotation part (the upper-left
+ * 3x3) of the given 4x4 matrix; translation doesn't mean anything for direction vectors such as
+ * normals, so compared to v_multiply_batch this skips the translation row and the w component
+ * entirely, saving a quarter of the multiplies and all of the perspective division checks
+ */
+STATIC mp_obj_t v_rotate_batch(size_t n_args, const mp_obj_t *args) {
+	mp_buffer_info_t vec_buffer, mat_buffer, dest_buffer;
+
+	mp_get_buffer_raise(args[0], &vec_buffer, MP_BUFFER_READ);
+	mp_get_buffer_raise(args[1], &mat_buffer, MP_BUFFER_READ);
+	if (n_args > 2) {
+		mp_get_buffer_raise(args[2], &dest_buffer, MP_BUFFER_RW);
+	} else {
+		dest_buffer = vec_buffer;
+	}
+
+	float *src = (float *)vec_buffer.buf;
+	float *mat = (float *)mat_buffer.buf;
+	float *dest = (float *)dest_buffer.buf;
+	size_t num_vecs = vec_buffer.len / (sizeof(float) * 3);
+
+	mp_float_t x, y, z;
+	mp_float_t xyz[3];
+
+	for (size_t j = 0; j < num_vecs; j++) {
+		// Do the multiplication
+		x = src[j * 3];
+		y = src[j * 3 + 1];
+		z = src[j * 3 + 2];
+		for (size_t i = 0; i < 3; i++) {
+			xyz[i] = x * mat[i] + y * mat[4 + i] + z * mat[8 + i];
+		}
+		dest[j * 3] = xyz[0];
+		dest[j * 3 + 1] = xyz[1];
+		dest[j * 3 + 2] = xyz[2];
+	}
+
+	return mp_const_none;
+}
+STATIC MP_DEFINE_CONST_FUN_OBJ_VAR_BETWEEN(v_rotate_batch_obj, 2, 3, v_rotate_batch);
+
 /**
  * Returns a scalar value of 0 if the given 3D vectors are exactly perpendicular, <0 if the angle
  * between them is greater than 90° or >0 if the angle between them is less than 90° (dot product)
@@ -308,6 +374,259 @@ STATIC mp_obj_t v_ndc_to_screen(size_t n_args, const mp_obj_t *args) {
 }
 STATIC MP_DEFINE_CONST_FUN_OBJ_VAR_BETWEEN(v_ndc_to_screen_obj, 4, 4, v_ndc_to_screen);
 
+/**
+ * Processes the given list of depth-sorted faces ready for drawing: tests each face for
+ * visibility, converts its normalised device coordinates to screen coordinates, and computes
+ * its lit and packed RGB565 colour, all in one native call so that none of the per-face work
+ * pays the interpreter dispatch cost
+ *
+ * faces: A list of (vert_indices, norm_index, col_index) tuples
+ * map: An array containing face index/depth pairs, sorted back to front
+ * map_size: Number of key/value pairs in the map
+ * vectors: Projected vertices in normalised device coords as a flat buffer, 3 floats per entry
+ * normals: Rotated face normal vectors as a flat buffer, 3 floats per entry
+ * light: The directional lighting vector
+ * colours: Material colours as an array of pre-packed RGB565 values, one per material
+ * ramps: Per-material shade ramps as a list of arrays of pre-packed RGB565 brightness levels
+ * mode: The render mode
+ * width: Width of the screen in pixels
+ * height: Height of the screen in pixels
+ * coords: A pre-allocated array of size (faces * 6) where the screen coords will be written
+ * face_colours: A pre-allocated array of size (faces) where the RGB565 colours will be written
+ * bounds: A pre-allocated array of 4 values where the screen-space bounding box of the visible
+ *         faces will be written as (min_x, min_y, max_x, max_y), unclamped to the screen
+ *
+ * Returns the number of visible faces written to the coords and face_colours buffers
+ */
+STATIC mp_obj_t f_process(size_t n_args, const mp_obj_t *args) {
+	size_t faces_len, face_len, indices_len, list_len;
+	mp_obj_t *faces, *face, *indices, *ramps;
+	mp_buffer_info_t map_buffer, vec_buffer, norm_buffer, light_buffer, col_buffer, ramp_buffer, coord_buffer, colour_buffer, bounds_buffer;
+
+	mp_obj_get_array(args[0], &faces_len, &faces);
+	mp_get_buffer_raise(args[1], &map_buffer, MP_BUFFER_READ);
+	mp_int_t map_size = mp_obj_get_int(args[2]);
+	mp_get_buffer_raise(args[3], &vec_buffer, MP_BUFFER_READ);
+	mp_get_buffer_raise(args[4], &norm_buffer, MP_BUFFER_READ);
+	mp_get_buffer_raise(args[5], &light_buffer, MP_BUFFER_READ);
+	mp_get_buffer_raise(args[6], &col_buffer, MP_BUFFER_READ);
+	mp_obj_get_array(args[7], &list_len, &ramps);
+	mp_int_t mode = mp_obj_get_int(args[8]);
+	mp_float_t w = mp_obj_get_float(args[9]);
+	mp_float_t h = mp_obj_get_float(args[10]);
+	mp_get_buffer_raise(args[11], &coord_buffer, MP_BUFFER_WRITE);
+	mp_get_buffer_raise(args[12], &colour_buffer, MP_BUFFER_WRITE);
+	mp_get_buffer_raise(args[13], &bounds_buffer, MP_BUFFER_WRITE);
+
+	float *map = (float *)map_buffer.buf;
+	float *ndc = (float *)vec_buffer.buf;
+	float *normals = (float *)norm_buffer.buf;
+	int16_t *coords = (int16_t *)coord_buffer.buf;
+	uint16_t *face_colours = (uint16_t *)colour_buffer.buf;
+	int16_t *bounds = (int16_t *)bounds_buffer.buf;
+
+	int16_t min_x = 0x7fff, min_y = 0x7fff;
+	int16_t max_x = -0x8000, max_y = -0x8000;
+
+	mp_int_t num_visible = 0;
+	for (mp_int_t i = 0; i < map_size * 2; i += 2) {
+		size_t face_index = (size_t)map[i];
+		mp_obj_get_array(faces[face_index], &face_len, &face);
+		mp_obj_get_array(face[0], &indices_len, &indices);
+
+		// Test the face for visibility while converting its vertices to screen coordinates,
+		// a projected vertex whose x and y components both lie between -1 and 1 results in a
+		// valid on-screen pixel location, and if at least one vertex can be seen we'll render
+		// the partial face
+		// The y axis is inverted because screens tend to have the origin 0,0 at the top left
+		// and increase towards the bottom
+		int visible = 0;
+		for (size_t j = 0; j < 3; j++) {
+			size_t vert_index = (size_t)mp_obj_get_int(indices[j]);
+			float x = ndc[vert_index * 3];
+			float y = ndc[vert_index * 3 + 1];
+			if (x > -1 && x < 1 && y > -1 && y < 1) {
+				visible = 1;
+			}
+			coords[num_visible * 6 + j * 2] = (int16_t)((x + 1) * 0.5 * w);
+			coords[num_visible * 6 + j * 2 + 1] = (int16_t)((1 - (y + 1) * 0.5) * h);
+		}
+		if (!visible) {
+			continue;
+		}
+
+		// Grow the bounding box of everything drawn this frame, so the app knows which
+		// region of the screen is dirty
+		for (size_t j = 0; j < 3; j++) {
+			int16_t x = coords[num_visible * 6 + j * 2];
+			int16_t y = coords[num_visible * 6 + j * 2 + 1];
+			if (x < min_x) min_x = x;
+			if (x > max_x) max_x = x;
+			if (y < min_y) min_y = y;
+			if (y > max_y) max_y = y;
+		}
+
+		uint16_t colour = 0xffff;
+		if (mode >= RENDER_MODE_SOLID_SHADED) {
+			// The angle of incidence of the light vector determines how brightly lit the
+			// face appears; quantise it to one of the brightness levels in the material's
+			// shade ramp, which has the colour scaling, the ambient minimum clamp and the
+			// RGB565 packing all baked in at mesh load time
+			float *normal = &normals[mp_obj_get_int(face[1]) * 3];
+			float dot = normal[0] * ((float *)light_buffer.buf)[0]
+				+ normal[1] * ((float *)light_buffer.buf)[1]
+				+ normal[2] * ((float *)light_buffer.buf)[2];
+			mp_int_t level = (mp_int_t)(-dot * 31);
+			if (level < 0) {
+				level = 0;
+			} else if (level > 31) {
+				level = 31;
+			}
+			mp_get_buffer_raise(ramps[mp_obj_get_int(face[2])], &ramp_buffer, MP_BUFFER_READ);
+			colour = ((uint16_t *)ramp_buffer.buf)[level];
+		} else if (mode > RENDER_MODE_POINT_CLOUD) {
+			// The material's colour is pre-packed into RGB565 at mesh load time, so this is
+			// just a table lookup by material index
+			colour = ((uint16_t *)col_buffer.buf)[mp_obj_get_int(face[2])];
+		}
+		face_colours[num_visible] = colour;
+		num_visible++;
+	}
+
+	bounds[0] = min_x;
+	bounds[1] = min_y;
+	bounds[2] = max_x;
+	bounds[3] = max_y;
+
+	return MP_OBJ_NEW_SMALL_INT(num_visible);
+}
+STATIC MP_DEFINE_CONST_FUN_OBJ_VAR_BETWEEN(f_process_obj, 14, 14, f_process);
+
+// Internal helper to rasterise one masked triangle, used by f_fill_masked and f_fill_batch
+STATIC void f_fill_masked_internal(uint16_t *fb, mp_int_t width, mp_int_t height, int16_t *coords, mp_int_t colour, uint8_t *mask) {
+	mp_int_t x0 = coords[0], y0 = coords[1];
+	mp_int_t x1 = coords[2], y1 = coords[3];
+	mp_int_t x2 = coords[4], y2 = coords[5];
+
+	// Twice the signed area of the triangle gives its winding; swap two vertices if needed
+	// so the edge tests below can always assume anti-clockwise, and skip degenerate
+	// triangles with no area at all
+	mp_int_t area = (x1 - x0) * (y2 - y0) - (x2 - x0) * (y1 - y0);
+	if (area == 0) {
+		return;
+	}
+	if (area < 0) {
+		mp_int_t tx = x1, ty = y1;
+		x1 = x2;
+		y1 = y2;
+		x2 = tx;
+		y2 = ty;
+	}
+
+	// Clamp the triangle's bounding box to the screen
+	mp_int_t min_x = x0 < x1 ? x0 : x1;
+	if (x2 < min_x) min_x = x2;
+	if (min_x < 0) min_x = 0;
+	mp_int_t max_x = x0 > x1 ? x0 : x1;
+	if (x2 > max_x) max_x = x2;
+	if (max_x > width - 1) max_x = width - 1;
+	mp_int_t min_y = y0 < y1 ? y0 : y1;
+	if (y2 < min_y) min_y = y2;
+	if (min_y < 0) min_y = 0;
+	mp_int_t max_y = y0 > y1 ? y0 : y1;
+	if (y2 > max_y) max_y = y2;
+	if (max_y > height - 1) max_y = height - 1;
+
+	// Walk the bounding box testing each pixel against the triangle's three edge functions,
+	// drawing only pixels whose coverage bit is still clear and setting the bit as we go
+	// The tests are inclusive on all edges, so pixels on an edge shared by two triangles are
+	// claimed by whichever is drawn first, leaving no seams between adjacent faces
+	for (mp_int_t y = min_y; y <= max_y; y++) {
+		for (mp_int_t x = min_x; x <= max_x; x++) {
+			mp_int_t e0 = (x1 - x0) * (y - y0) - (y1 - y0) * (x - x0);
+			mp_int_t e1 = (x2 - x1) * (y - y1) - (y2 - y1) * (x - x1);
+			mp_int_t e2 = (x0 - x2) * (y - y2) - (y0 - y2) * (x - x2);
+			if (e0 >= 0 && e1 >= 0 && e2 >= 0) {
+				size_t pixel = y * width + x;
+				if (!(mask[pixel >> 3] & (1 << (pixel & 7)))) {
+					mask[pixel >> 3] |= 1 << (pixel & 7);
+					fb[pixel] = colour;
+				}
+			}
+		}
+	}
+}
+
+/**
+ * Draws a filled triangle into an RGB565 framebuffer, but only to pixels whose bit in the
+ * given 1-bit-per-pixel coverage mask is still clear, setting the bit for every pixel it
+ * writes; when faces are drawn front to back sharing one mask, each pixel is written at most
+ * once per frame by the nearest face that covers it, eliminating overdraw entirely
+ *
+ * buffer: The framebuffer, 2 bytes per pixel
+ * width: Width of the framebuffer in pixels
+ * height: Height of the framebuffer in pixels
+ * coords: An array of 6 screen coordinates describing the triangle
+ * colour: The RGB565 colour to fill with, already in framebuffer byte order
+ * mask: The coverage mask, 1 bit per pixel, at least (width * height + 7) / 8 bytes
+ */
+STATIC mp_obj_t f_fill_masked(size_t n_args, const mp_obj_t *args) {
+	mp_buffer_info_t fb_buffer, coord_buffer, mask_buffer;
+	mp_get_buffer_raise(args[0], &fb_buffer, MP_BUFFER_RW);
+	mp_int_t width = mp_obj_get_int(args[1]);
+	mp_int_t height = mp_obj_get_int(args[2]);
+	mp_get_buffer_raise(args[3], &coord_buffer, MP_BUFFER_READ);
+	mp_int_t colour = mp_obj_get_int(args[4]);
+	mp_get_buffer_raise(args[5], &mask_buffer, MP_BUFFER_RW);
+
+	f_fill_masked_internal((uint16_t *)fb_buffer.buf, width, height, (int16_t *)coord_buffer.buf, colour, (uint8_t *)mask_buffer.buf);
+
+	return mp_const_none;
+}
+STATIC MP_DEFINE_CONST_FUN_OBJ_VAR_BETWEEN(f_fill_masked_obj, 6, 6, f_fill_masked);
+
+/**
+ * Draws a whole frame's worth of filled triangles into an RGB565 framebuffer in one call,
+ * walking the flat coordinate and colour buffers produced by f_process from the nearest face
+ * to the furthest through a shared coverage mask; batching the faces amortises the cost of
+ * crossing the interpreter boundary, which is significant per call, across the entire draw
+ *
+ * buffer: The framebuffer, 2 bytes per pixel
+ * width: Width of the framebuffer in pixels
+ * height: Height of the framebuffer in pixels
+ * coords: An array of 6 screen coordinates per triangle, ordered back to front
+ * colours: An array of one RGB565 colour per triangle, in logical byte order
+ * num_faces: How many triangles from the buffers to draw
+ * mask: The coverage mask, 1 bit per pixel, at least (width * height + 7) / 8 bytes
+ */
+STATIC mp_obj_t f_fill_batch(size_t n_args, const mp_obj_t *args) {
+	mp_buffer_info_t fb_buffer, coord_buffer, colour_buffer, mask_buffer;
+	mp_get_buffer_raise(args[0], &fb_buffer, MP_BUFFER_RW);
+	mp_int_t width = mp_obj_get_int(args[1]);
+	mp_int_t height = mp_obj_get_int(args[2]);
+	mp_get_buffer_raise(args[3], &coord_buffer, MP_BUFFER_READ);
+	mp_get_buffer_raise(args[4], &colour_buffer, MP_BUFFER_READ);
+	mp_int_t num_faces = mp_obj_get_int(args[5]);
+	mp_get_buffer_raise(args[6], &mask_buffer, MP_BUFFER_RW);
+
+	uint16_t *fb = (uint16_t *)fb_buffer.buf;
+	int16_t *coords = (int16_t *)coord_buffer.buf;
+	uint16_t *colours = (uint16_t *)colour_buffer.buf;
+	uint8_t *mask = (uint8_t *)mask_buffer.buf;
+
+	// The buffers are ordered back to front by the painter's sort, so walk them in reverse to
+	// draw front to back; the framebuffer's byte order is swapped relative to the logical
+	// colour values, so swap each colour here once per face
+	for (mp_int_t i = num_faces - 1; i >= 0; i--) {
+		mp_int_t colour = colours[i];
+		colour = ((colour >> 8) | (colour << 8)) & 0xffff;
+		f_fill_masked_internal(fb, width, height, &coords[i * 6], colour, mask);
+	}
+
+	return mp_const_none;
+}
+STATIC MP_DEFINE_CONST_FUN_OBJ_VAR_BETWEEN(f_fill_batch_obj, 7, 7, f_fill_batch);
+
 // Internal helper to calculate matrix multiplication used by m_multiply, m_translate and m_rotate
 STATIC void m_multiply_internal(float *dest, float *mat1, float *mat2) {
 	float m0[4], m1[4], m2[4], m3[4];
@@ -445,25 +764,60 @@ STATIC mp_obj_t q_rotate(mp_obj_t quaternion, mp_obj_t degrees, mp_obj_t vector)
 }
 STATIC MP_DEFINE_CONST_FUN_OBJ_3(q_rotate_obj, q_rotate);
 
-// Sort comparison function used by z_sort
-STATIC int sort_cmp(const void *a, const void *b) {
-	const float *aa = a;
-	const float *bb = b;
+/**
+ * Integrates the given orientation quaternion by the given angular velocity vector (in degrees
+ * per second) over the given time delta; this is equivalent to composing v_magnitude,
+ * v_normalise and q_rotate but runs as one native call per update instead of three, and folds
+ * the axis normalisation into the sin factor so the divides collapse into one
+ */
+STATIC mp_obj_t q_integrate(mp_obj_t quaternion, mp_obj_t angular, mp_obj_t delta_t) {
+	mp_buffer_info_t quat_buffer, ang_buffer;
+	mp_get_buffer_raise(quaternion, &quat_buffer, MP_BUFFER_RW);
+	mp_get_buffer_raise(angular, &ang_buffer, MP_BUFFER_READ);
+	mp_float_t dt = mp_obj_get_float(delta_t);
 
-	// We are sorting key/value pairs, and we want to sort by the value, hence indexing into
-	// the second float of the element being sorted
-	if (aa[1] < bb[1]) {
-		return -1;
-	} else if (aa[1] > bb[1]) {
-		return 1;
+	float *ang = (float *)ang_buffer.buf;
+	mp_float_t degrees = v_magnitude_internal(ang, 3);
+
+	float q1w = ((float *)quat_buffer.buf)[0];
+	float q1x = ((float *)quat_buffer.buf)[1];
+	float q1y = ((float *)quat_buffer.buf)[2];
+	float q1z = ((float *)quat_buffer.buf)[3];
+
+	// Compute a rotation quaternion from the angle and the axis, dividing the sin factor by
+	// the magnitude normalises the axis at the same time; a zero angular velocity yields the
+	// identity quaternion
+	float theta = (degrees * dt * DEGS_TO_RADS) / 2;
+	float factor = 0;
+	if (degrees != 0) {
+		factor = sin(theta) / degrees;
 	}
-	return 0;
+	float q2w = cos(theta);
+	float q2x = ang[0] * factor;
+	float q2y = ang[1] * factor;
+	float q2z = ang[2] * factor;
+
+	// Multiply the given quaternion by the rotation quaternion
+	((float *)quat_buffer.buf)[0] = q1w * q2w - q1x * q2x - q1y * q2y - q1z * q2z;
+	((float *)quat_buffer.buf)[1] = q1w * q2x + q1x * q2w + q1y * q2z - q1z * q2y;
+	((float *)quat_buffer.buf)[2] = q1w * q2y - q1x * q2z + q1y * q2w + q1z * q2x;
+	((float *)quat_buffer.buf)[3] = q1w * q2z + q1x * q2y - q1y * q2x + q1z * q2w;
+	return mp_const_none;
 }
+STATIC MP_DEFINE_CONST_FUN_OBJ_3(q_integrate_obj, q_integrate);
+
+// Number of quantised depth buckets used by z_sort, the painter's algorithm only needs faces
+// in approximately back-to-front order so values that land in the same bucket can be drawn in
+// any order with no visible difference
+#define Z_SORT_BUCKETS (64)
 
 /**
  * A custom fast sorting function for sorting python arrays that contain key/value pairs of
- * floats, for example this is useful for depth-sorting faces given an array containing face
- * index/depth pairs
+ * floats by the value, for example this is useful for depth-sorting faces given an array
+ * containing face index/depth pairs
+ *
+ * Values are quantised into a fixed number of buckets and counting-sorted, which is O(n) in
+ * the number of pairs rather than the O(n log n) of a comparison sort
  *
  * map: An array containing key/value pairs
  * map_size: Number of key/value pairs in the map
@@ -473,12 +827,51 @@ STATIC mp_obj_t z_sort(size_t n_args, const mp_obj_t *args) {
 	mp_get_buffer_raise(args[0], &map_buffer, MP_BUFFER_RW);
 	mp_int_t map_size = mp_obj_get_int(args[1]);
 
-	// For sorting purposes an element is double the size of an array element because we are
-	// sorting key/value pairs, not individual elements
-	size_t elem_size = mp_binary_get_size('@', map_buffer.typecode, NULL) * 2;
+	if (map_size < 2) {
+		return mp_const_none;
+	}
+
+	float *map = (float *)map_buffer.buf;
+
+	// Find the range of values so the bucket scale adapts to whatever is on screen this frame
+	float v_min = map[1], v_max = map[1];
+	for (mp_int_t i = 1; i < map_size; i++) {
+		float v = map[i * 2 + 1];
+		if (v < v_min) {
+			v_min = v;
+		}
+		if (v > v_max) {
+			v_max = v;
+		}
+	}
+	float scale = 0;
+	if (v_max > v_min) {
+		scale = (Z_SORT_BUCKETS - 1) / (v_max - v_min);
+	}
+
+	// Count how many pairs quantise into each bucket, then turn the counts into each bucket's
+	// starting offset in the sorted output
+	size_t counts[Z_SORT_BUCKETS] = {0};
+	for (mp_int_t i = 0; i < map_size; i++) {
+		counts[(size_t)((map[i * 2 + 1] - v_min) * scale)]++;
+	}
+	size_t offset = 0;
+	for (size_t b = 0; b < Z_SORT_BUCKETS; b++) {
+		size_t count = counts[b];
+		counts[b] = offset;
+		offset += count;
+	}
+
+	// Scatter the pairs into a scratch buffer in bucket order and copy the result back
+	float *sorted = m_new(float, map_size * 2);
+	for (mp_int_t i = 0; i < map_size; i++) {
+		size_t at = counts[(size_t)((map[i * 2 + 1] - v_min) * scale)]++;
+		sorted[at * 2] = map[i * 2];
+		sorted[at * 2 + 1] = map[i * 2 + 1];
+	}
+	memcpy(map, sorted, map_size * 2 * sizeof(float));
+	m_del(float, sorted, map_size * 2);
 
-	// Perform the sort
-	qsort(((float *)map_buffer.buf), map_size, elem_size, sort_cmp);
 	return mp_const_none;
 }
 STATIC MP_DEFINE_CONST_FUN_OBJ_VAR_BETWEEN(z_sort_obj, 2, 2, z_sort);
@@ -494,13 +887,18 @@ STATIC const mp_rom_map_elem_t tidal3d_module_globals_table[] = {
     { MP_ROM_QSTR(MP_QSTR_v_average), MP_ROM_PTR(&v_average_obj) },
     { MP_ROM_QSTR(MP_QSTR_v_multiply), MP_ROM_PTR(&v_multiply_obj) },
     { MP_ROM_QSTR(MP_QSTR_v_multiply_batch), MP_ROM_PTR(&v_multiply_batch_obj) },
+    { MP_ROM_QSTR(MP_QSTR_v_rotate_batch), MP_ROM_PTR(&v_rotate_batch_obj) },
     { MP_ROM_QSTR(MP_QSTR_v_dot), MP_ROM_PTR(&v_dot_obj) },
     { MP_ROM_QSTR(MP_QSTR_v_cross), MP_ROM_PTR(&v_cross_obj) },
     { MP_ROM_QSTR(MP_QSTR_v_ndc_to_screen), MP_ROM_PTR(&v_ndc_to_screen_obj) },
+    { MP_ROM_QSTR(MP_QSTR_f_process), MP_ROM_PTR(&f_process_obj) },
+    { MP_ROM_QSTR(MP_QSTR_f_fill_masked), MP_ROM_PTR(&f_fill_masked_obj) },
+    { MP_ROM_QSTR(MP_QSTR_f_fill_batch), MP_ROM_PTR(&f_fill_batch_obj) },
     { MP_ROM_QSTR(MP_QSTR_m_multiply), MP_ROM_PTR(&m_multiply_obj) },
     { MP_ROM_QSTR(MP_QSTR_m_translate), MP_ROM_PTR(&m_translate_obj) },
     { MP_ROM_QSTR(MP_QSTR_m_rotate), MP_ROM_PTR(&m_rotate_obj) },
     { MP_ROM_QSTR(MP_QSTR_q_rotate), MP_ROM_PTR(&q_rotate_obj) },
+    { MP_ROM_QSTR(MP_QSTR_q_integrate), MP_ROM_PTR(&q_integrate_obj) },
     { MP_ROM_QSTR(MP_QSTR_z_sort), MP_ROM_PTR(&z_sort_obj) },
 };
 STATIC MP_DEFINE_CONST_DICT(tidal3d_module_globals, tidal3d_module_globals_table);